@@ -0,0 +1,48 @@
+# coding: utf-8
+
+# Fused sky <-> cartesian conversions used by recon.py, compiled with numba.
+# Each row is converted in a single pass, without the full-size temporaries (cos(dec), cos(dec) * cos(ra), ...)
+# that the equivalent numpy expressions allocate. Signatures follow pyrecon.utils.
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _sky_to_cartesian(ra, dec, dist, out, deg2rad):
+    for i in prange(ra.size):
+        cosdec = math.cos(dec[i] * deg2rad)
+        rarad = ra[i] * deg2rad
+        out[i, 0] = dist[i] * cosdec * math.cos(rarad)
+        out[i, 1] = dist[i] * cosdec * math.sin(rarad)
+        out[i, 2] = dist[i] * math.sin(dec[i] * deg2rad)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _cartesian_to_sky(positions, out_dist, out_ra, out_dec, rad2deg):
+    for i in prange(positions.shape[0]):
+        x, y, z = positions[i, 0], positions[i, 1], positions[i, 2]
+        dist = math.sqrt(x * x + y * y + z * z)
+        ra = math.atan2(y, x) * rad2deg
+        if ra < 0: ra += 360
+        out_dist[i] = dist
+        out_ra[i] = ra
+        out_dec[i] = math.asin(z / dist) * rad2deg
+
+
+def sky_to_cartesian(dist, ra, dec, dtype='f4', out=None):
+    """Return (N, 3) cartesian positions from distance, RA, Dec (in degrees), written into ``out`` if provided."""
+    if out is None:
+        out = np.empty((len(ra), 3), dtype=dtype)
+    _sky_to_cartesian(ra, dec, dist, out, out.dtype.type(np.pi / 180.))
+    return out
+
+
+def cartesian_to_sky(positions, dtype=None):
+    """Return distance, RA (wrapped to [0, 360)), Dec (in degrees) from (N, 3) cartesian positions."""
+    dtype = positions.dtype if dtype is None else np.dtype(dtype)
+    dist, ra, dec = (np.empty(len(positions), dtype=dtype) for i in range(3))
+    _cartesian_to_sky(positions, dist, ra, dec, dtype.type(180. / np.pi))
+    return dist, ra, dec
@@ -2,42 +2,272 @@
 # coding: utf-8
 
 import os
+import re
+import ctypes
+import shutil
+import tempfile
 import argparse
 import logging
+import functools
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
-from astropy.table import Table, vstack
+import fitsio
 
-from pyrecon import MultiGridReconstruction, IterativeFFTReconstruction, IterativeFFTParticleReconstruction, utils, setup_logging
-from LSS.tabulated_cosmo import TabulatedDESI
-
-from xirunpc import get_clustering_positions_weights, catalog_dir, catalog_fn, get_regions, get_zlims
+# pyrecon, LSS.tabulated_cosmo, xirunpc (pycorr, matplotlib) and numba are slow to import:
+# they are imported where needed, such that e.g. --help or importing get_f_bias is fast
 
 
 logger = logging.getLogger('recon')
 
+_scratch = {}
+
+
+def get_scratch(size, dtype):
+    # Temporary array of size elements, reusing the same memory from one call to the next
+    dtype = np.dtype(dtype)
+    if dtype not in _scratch or _scratch[dtype].size < size:
+        _scratch[dtype] = np.empty(size, dtype=dtype)
+    return _scratch[dtype][:size]
+
+
+def sky_to_cartesian_numpy(dist, ra, dec, dtype='f4', out=None):
+    # Same as pyrecon.utils.sky_to_cartesian, but computed directly into out, with scratch temporaries
+    size = len(ra)
+    if out is None: out = np.empty((size, 3), dtype=dtype)
+    scratch = get_scratch(2 * size, out.dtype)
+    angle, dist_cosdec = scratch[:size], scratch[size:]
+    np.radians(dec, out=angle)
+    np.sin(angle, out=out[:, 2])
+    out[:, 2] *= dist
+    np.cos(angle, out=dist_cosdec)
+    dist_cosdec *= dist
+    np.radians(ra, out=angle)
+    np.cos(angle, out=out[:, 0])
+    out[:, 0] *= dist_cosdec
+    np.sin(angle, out=out[:, 1])
+    out[:, 1] *= dist_cosdec
+    return out
+
+
+def get_sky_cartesian():
+    # numba kernels if available, else numpy
+    try:
+        from _recon_kernels import sky_to_cartesian, cartesian_to_sky
+    except ImportError:  # numba not available
+        from pyrecon.utils import cartesian_to_sky
+        sky_to_cartesian = sky_to_cartesian_numpy
+    return sky_to_cartesian, cartesian_to_sky
+
+
+def read_catalog(fn, columns=None):
+    # fitsio is much faster than astropy's Table.read; returns a numpy structured array and the header
+    logger.info('Loading {}.'.format(fn))
+    return fitsio.read(fn, ext=1, columns=columns, header=True)
+
+
+def get_nrows(fn):
+    # Only reads the header
+    with fitsio.FITS(fn) as file:
+        return file[1].get_nrows()
+
+
+@contextlib.contextmanager
+def atomic_output(fn):
+    # Temporary file name in the same directory as fn, renamed to fn once written: if interrupted, no partial fn is left behind
+    # (which the existing output check in __main__ would take as complete)
+    tmp_fn = '{}.{:d}.tmp'.format(fn, os.getpid())
+    try:
+        yield tmp_fn
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.exists(tmp_fn): os.remove(tmp_fn)
+
+
+def write_catalog(fn, catalog, header=None):
+    logger.info('Saving {}.'.format(fn))
+    with atomic_output(fn) as tmp_fn:
+        fitsio.write(tmp_fn, catalog, header=header, clobber=True)
+
+
+def write_columns(fn, rec_fn, **columns):
+    # All rows of fn are kept: copy it and only overwrite the input columns in place, instead of rewriting the full catalog
+    logger.info('Saving {}.'.format(rec_fn))
+    with atomic_output(rec_fn) as tmp_fn:
+        shutil.copyfile(fn, tmp_fn)
+        with fitsio.FITS(tmp_fn, 'rw') as file:
+            dtype = file[1].get_rec_dtype()[0]
+            for name, value in columns.items():
+                file[1].write_column(name, np.asarray(value, dtype=dtype[name]))
+
+
+def get_fftw_version(dtype='f4'):
+    # Version string of the FFTW library loaded by pyfftw, which lists enabled SIMD instruction sets, e.g. fftw-3.3.8-sse2-avx-avx2-avx2_128;
+    # None if it cannot be found
+    import pyfftw
+    single = np.dtype(dtype).itemsize == 4
+    pattern = re.compile(r'/libfftw3{}[-.]'.format('f' if single else ''))  # e.g. libfftw3f.so.3, not libfftw3f_threads.so.3
+    try:
+        with open('/proc/self/maps') as file:
+            libs = sorted({line.split()[-1] for line in file if pattern.search(line)})
+    except OSError:
+        return None
+    for lib in libs:
+        try:
+            version = ctypes.c_char.in_dll(ctypes.CDLL(lib), 'fftwf_version' if single else 'fftw_version')
+        except (OSError, ValueError):
+            continue
+        return ctypes.string_at(ctypes.addressof(version)).decode()
+    return None
+
+
+_writer = None
+
+
+def submit_write(func, *args, **kwargs):
+    # Run a catalog write in a background thread, shared by all reconstructions, such that it overlaps with the following computations
+    global _writer
+    if _writer is None: _writer = ThreadPoolExecutor(max_workers=1)
+    return _writer.submit(func, *args, **kwargs)
+
+
+def wait_writes(writes):
+    # Wait for pending writes (raising their errors, if any) and empty the list
+    while writes:
+        writes.pop(0).result()
+
+
+def load_wisdom(fn):
+    # FFTW wisdom, as saved by save_wisdom
+    if fn is None or not os.path.isfile(fn):
+        return None
+    logger.info('Loading FFTW wisdom {}.'.format(fn))
+    try:
+        return tuple(np.load(fn))
+    except (OSError, ValueError, EOFError) as exc:
+        logger.warning('Could not read FFTW wisdom {} ({}); FFT plans will be measured again.'.format(fn, exc))
+        return None
+
+
+def export_wisdom():
+    # All FFTW wisdom gathered by this process (FFTW keeps it for the whole process)
+    import pyfftw
+    return pyfftw.export_wisdom()
+
+
+def merge_wisdom(*wisdoms):
+    # Wisdom returned by several processes, merged into that of the current process
+    import pyfftw
+    for wisdom in wisdoms:
+        if wisdom is not None: pyfftw.import_wisdom(wisdom)
+    return pyfftw.export_wisdom()
+
 
-def run_reconstruction(Reconstruction, distance, data_fn, randoms_fn, data_rec_fn, randoms_rec_fn, f=0.8, bias=1.2, boxsize=None, nmesh=None, cellsize=7, smoothing_radius=15, nthreads=8, convention='reciso', dtype='f4', **kwargs):
+def save_wisdom(fn, wisdom):
+    # Written to a temporary file, then renamed: concurrent runs sharing the same file never leave it truncated
+    logger.info('Saving FFTW wisdom {}.'.format(fn))
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)), prefix=os.path.basename(fn), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, wisdom)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.remove(tmp_fn)
+        raise
 
-    if np.ndim(randoms_fn) == 0: randoms_fn = [randoms_fn]
-    if np.ndim(randoms_rec_fn) == 0: randoms_rec_fn = [randoms_rec_fn]
 
-    logger.info('Loading {}.'.format(data_fn))
-    data = Table.read(data_fn)
-    (ra, dec, dist), data_weights, mask = get_clustering_positions_weights(data, distance, name='data', return_mask=True, **kwargs)
-    data = data[mask]
-    data_positions = utils.sky_to_cartesian(dist, ra, dec, dtype=dtype)
-    recon = Reconstruction(f=f, bias=bias, boxsize=boxsize, nmesh=nmesh, cellsize=cellsize, los='local', positions=data_positions, nthreads=nthreads, fft_engine='fftw', dtype=dtype)
+def smooth_nmesh(nmesh, primes=(2, 3, 5, 7)):
+    # Smallest even integer >= nmesh with no other prime factors than primes, for which FFTW has fast codelets
+    nmesh = int(nmesh)
+    while True:
+        nmesh += nmesh % 2
+        remainder = nmesh
+        for prime in primes:
+            while remainder % prime == 0: remainder //= prime
+        if remainder == 1:
+            return nmesh
+        nmesh += 1
+
+
+def get_mesh_attrs(positions, boxsize=None, cellsize=7, boxpad=2.):
+    # Cubic box enclosing positions (padded by boxpad, as pyrecon does by default),
+    # with a FFT-friendly number of cells, the box being enlarged to keep the cell size
+    pos_min, pos_max = positions.min(axis=0), positions.max(axis=0)
+    boxcenter = (pos_min + pos_max) / 2.
+    if boxsize is None: boxsize = (pos_max - pos_min).max() * boxpad
+    nmesh = smooth_nmesh(np.ceil(boxsize / cellsize))
+    return nmesh, nmesh * cellsize, boxcenter
+
+
+def get_positions_weights(catalog, distance, dtype='f4', **kwargs):
+    # Cast to the reconstruction dtype right away, so that coordinate conversions run on (and write) single-precision arrays
+    from xirunpc import get_clustering_positions_weights
+    (ra, dec, dist), weights, mask = get_clustering_positions_weights(catalog, distance, return_mask=True, **kwargs)
+    ra, dec, dist, weights = (np.asarray(array, dtype=dtype) for array in (ra, dec, dist, weights))
+    return (ra, dec, dist), weights, mask
+
+
+def run_reconstruction(Reconstruction, distance, distance_to_redshift, data_fn, randoms_fn, data_rec_fn, randoms_rec_fn, f=0.8, bias=1.2, boxsize=None, nmesh=None, cellsize=7, smoothing_radius=15, nthreads=8, convention='reciso', dtype='f4', stream_randoms=False, writes=None, **kwargs):
+
+    from pyrecon import IterativeFFTParticleReconstruction
+    from xirunpc import get_clustering_positions_weights
+    sky_to_cartesian, cartesian_to_sky = get_sky_cartesian()
+    logger.info('Running reconstruction of {} in redshift range {} with f, bias = {}.'.format(data_fn, kwargs.get('zlim'), (f, bias)))
+
+    # Catalogs are written in the background; if a list of writes is provided, those are left for the caller to wait for,
+    # such that they overlap with the next reconstruction
+    wait = writes is None
+    if wait: writes = []
+
+    if isinstance(randoms_fn, str): randoms_fn = [randoms_fn]
+    if isinstance(randoms_rec_fn, str): randoms_rec_fn = [randoms_rec_fn]
+
+    def load_randoms(fn):
+        catalog, header = read_catalog(fn)
+        (ra, dec, dist), weights, mask = get_positions_weights(catalog, distance, dtype=dtype, name='randoms', **kwargs)
+        complete = mask.all()
+        catalog = None if complete or stream_randoms else (catalog[mask], header)
+        return catalog, complete, (ra, dec, dist), weights
+
+    data, data_header = read_catalog(data_fn)
+    (ra, dec, dist), data_weights, mask = get_positions_weights(data, distance, dtype=dtype, name='data', **kwargs)
+    # Full data table is only masked (copied) when writing it out, after reconstruction
+    if mask.all(): data = data_index = None
+    else: data_index = np.flatnonzero(mask)
+    data_positions = sky_to_cartesian(dist, ra, dec, dtype=dtype)
+    mesh_kwargs = dict(boxsize=boxsize, nmesh=nmesh, cellsize=cellsize)
+    if nmesh is None:
+        nmesh, boxsize, boxcenter = get_mesh_attrs(data_positions, boxsize=boxsize, cellsize=cellsize)
+        logger.info('Using nmesh = {:d}, boxsize = {:.1f}.'.format(nmesh, boxsize))
+        mesh_kwargs = dict(boxsize=boxsize, boxcenter=boxcenter, nmesh=nmesh)
+    recon = Reconstruction(f=f, bias=bias, **mesh_kwargs, los='local', positions=data_positions, nthreads=nthreads, fft_engine='fftw', fft_plan='measure', dtype=dtype)
 
     recon.assign_data(data_positions, data_weights)
-    for fn in randoms_fn:
-        logger.info('Loading {}.'.format(fn))
-        (ra, dec, dist), randoms_weights = get_clustering_positions_weights(Table.read(fn), distance, name='randoms', **kwargs)
-        randoms_positions = utils.sky_to_cartesian(dist, ra, dec, dtype=dtype)
-        recon.assign_randoms(randoms_positions, randoms_weights)
+    # Randoms positions (converted in place) and weights are gathered into single buffers (sized from FITS headers),
+    # assigned in one go, then reused for the shift step.
+    # Unless streaming, masked randoms catalogs are kept as well (if not complete), to avoid reading them twice
+    size = sum(get_nrows(fn) for fn in randoms_fn)
+    randoms_positions, randoms_weights = np.empty((size, 3), dtype=dtype), np.empty(size, dtype=dtype)
+    randoms_slices, randoms_cache, randoms_complete = [], [], []
+    start = 0
+    for catalog, complete, (ra, dec, dist), weights in map(load_randoms, randoms_fn):
+        stop = start + len(weights)
+        sky_to_cartesian(dist, ra, dec, out=randoms_positions[start:stop])
+        randoms_weights[start:stop] = weights
+        randoms_slices.append(slice(start, stop))
+        randoms_cache.append(catalog)
+        randoms_complete.append(complete)
+        del catalog, ra, dec, dist, weights
+        start = stop
+    recon.assign_randoms(randoms_positions[:start], randoms_weights[:start])
+    del randoms_weights
 
     recon.set_density_contrast(smoothing_radius=smoothing_radius)
     recon.run()
+    # Outputs of the previous reconstruction, if any, should be written by now; this bounds the amount of pending outputs
+    wait_writes(writes)
 
     field = 'disp+rsd'
     if type(recon) is IterativeFFTParticleReconstruction:
@@ -45,23 +275,46 @@ def run_reconstruction(Reconstruction, distance, data_fn, randoms_fn, data_rec_f
     else:
         data_positions_rec = recon.read_shifted_positions(data_positions, field=field)
 
-    distance_to_redshift = utils.DistanceToRedshift(distance)
-    catalog = Table(data)
-    dist, ra, dec = utils.cartesian_to_sky(data_positions_rec)
-    catalog['RA'], catalog['DEC'], catalog['Z'] = ra, dec, distance_to_redshift(dist)
-    logger.info('Saving {}.'.format(data_rec_fn))
-    catalog.write(data_rec_fn, format='fits', overwrite=True)
+    dist, ra, dec = cartesian_to_sky(data_positions_rec)
+    if data is None:
+        writes.append(submit_write(write_columns, data_fn, data_rec_fn, RA=ra, DEC=dec, Z=distance_to_redshift(dist)))
+    else:
+        data = data[data_index]
+        data['RA'], data['DEC'], data['Z'] = ra, dec, distance_to_redshift(dist)
+        writes.append(submit_write(write_catalog, data_rec_fn, data, header=data_header))
+    del data
 
     field = 'disp+rsd' if convention == 'recsym' else 'disp'
-    for fn, rec_fn in zip(randoms_fn, randoms_rec_fn):
-        catalog = Table.read(fn)
-        (ra, dec, dist), randoms_weights, mask = get_clustering_positions_weights(catalog, distance, name='randoms', return_mask=True, **kwargs)
-        catalog = catalog[mask]
-        randoms_positions = utils.sky_to_cartesian(dist, ra, dec, dtype=dtype)
-        dist, ra, dec = utils.cartesian_to_sky(recon.read_shifted_positions(randoms_positions, field=field))
+    for ifn, (fn, rec_fn) in enumerate(zip(randoms_fn, randoms_rec_fn)):
+        dist, ra, dec = cartesian_to_sky(recon.read_shifted_positions(randoms_positions[randoms_slices[ifn]], field=field))
+        if randoms_complete[ifn]:
+            writes.append(submit_write(write_columns, fn, rec_fn, RA=ra, DEC=dec, Z=distance_to_redshift(dist)))
+            continue
+        if stream_randoms:
+            catalog, header = read_catalog(fn)
+            catalog = catalog[get_clustering_positions_weights(catalog, distance, name='randoms', return_mask=True, **kwargs)[-1]]
+        else:
+            catalog, header = randoms_cache[ifn]
+            randoms_cache[ifn] = None  # release memory as we go
         catalog['RA'], catalog['DEC'], catalog['Z'] = ra, dec, distance_to_redshift(dist)
-        logger.info('Saving {}.'.format(rec_fn))
-        catalog.write(rec_fn, format='fits', overwrite=True)
+        writes.append(submit_write(write_catalog, rec_fn, catalog, header=header))
+        del catalog
+
+    del recon
+    if wait: wait_writes(writes)
+
+
+def init_worker(wisdom=None):
+    # Worker processes start with empty FFTW wisdom: import that of the parent process once
+    from pyrecon import setup_logging
+    setup_logging()
+    merge_wisdom(wisdom)
+
+
+def run_reconstruction_worker(*args, **kwargs):
+    # run_reconstruction in a worker process, returning its FFTW wisdom to be merged by the parent process
+    run_reconstruction(*args, **kwargs)
+    return export_wisdom()
 
 
 def get_f_bias(tracer='ELG'):
@@ -82,6 +335,7 @@ if __name__ == '__main__':
     parser.add_argument('--version', help='catalog version', type=str, default='test')
     parser.add_argument('--region', help='regions; by default, run on all regions', type=str, nargs='*', choices=['N', 'S', 'DN', 'DS', ''], default=None)
     parser.add_argument('--zlim', help='z-limits, or options for z-limits, e.g. "highz", "lowz"', type=str, nargs='*', default=None)
+    parser.add_argument('--zbins', help='run reconstruction separately in each redshift bin of --zlim (with smaller meshes) rather than in the full redshift range; output catalogs are then suffixed by the redshift range, e.g. MGreciso_z0.8-1.1, and read by xirunpc.py with --rec_zbins', action='store_true', default=False)
     parser.add_argument('--weight_type', help='types of weights to use; "default" just uses WEIGHT column', type=str, default='default')
     parser.add_argument('--nran', help='number of random files to combine together (1-18 available)', type=int, default=5)
     parser.add_argument('--nthreads', help='number of threads', type=int, default=64)
@@ -94,10 +348,29 @@ if __name__ == '__main__':
     parser.add_argument('--nmesh', help='mesh size', type=int, default=None)
     parser.add_argument('--cellsize', help='cell size', type=float, default=7)
     parser.add_argument('--smoothing_radius', help='smoothing radius', type=float, default=15)
+    parser.add_argument('--wisdom', help='FFTW wisdom file, loaded at start and updated at the end; "" to disable', type=str, default=os.path.join(os.path.expanduser('~'), '.fftw_wisdom_recon.npy'))
+    parser.add_argument('--nregions_parallel', help='number of (region, redshift range) reconstructions to run in parallel processes, sharing nthreads', type=int, default=1)
+    parser.add_argument('--skip_fftw_check', help='run even if FFTW was not built with AVX2 codelets', action='store_true', default=False)
+    parser.add_argument('--force', help='run reconstruction even if output catalogs already exist', action='store_true', default=False)
+    parser.add_argument('--stream_randoms', help='read randoms catalogs again when saving shifted randoms instead of keeping them in memory (for large nran)', action='store_true', default=False)
 
-    setup_logging()
     args = parser.parse_args()
 
+    from pyrecon import MultiGridReconstruction, IterativeFFTReconstruction, IterativeFFTParticleReconstruction, utils, setup_logging
+    from LSS.tabulated_cosmo import TabulatedDESI
+    from xirunpc import catalog_dir, catalog_fn, get_regions, get_zlims
+
+    setup_logging()
+
+    fftw_version = get_fftw_version(dtype='f4')
+    if fftw_version is None:
+        logger.warning('Could not check whether FFTW was built with AVX2 codelets.')
+    else:
+        logger.info('Using {}.'.format(fftw_version))
+        if '-avx2' not in fftw_version and not args.skip_fftw_check:
+            raise ValueError('FFTW loaded by pyfftw ({}) was built without AVX2 codelets, which makes FFTs several times slower; '
+                             'see the README for how to build it, or pass --skip_fftw_check to run anyway.'.format(fftw_version))
+
     Reconstruction = {'MG': MultiGridReconstruction, 'IFT': IterativeFFTReconstruction, 'IFTP': IterativeFFTParticleReconstruction}[args.algorithm]
 
     cat_dir = catalog_dir(base_dir=args.basedir, survey=args.survey, verspec=args.verspec, version=args.version)
@@ -105,6 +378,8 @@ if __name__ == '__main__':
     if args.outdir is not None: out_dir = args.outdir
 
     distance = TabulatedDESI().comoving_radial_distance
+    # Tabulated once (spline on a z-grid), shared by all regions / redshift ranges
+    distance_to_redshift = utils.DistanceToRedshift(distance)
 
     f, bias = get_f_bias(args.tracer)
     if args.f is not None: f = args.f
@@ -120,14 +395,50 @@ if __name__ == '__main__':
         zlims = get_zlims(args.tracer, option=args.zlim[0])
     else:
         zlims = [float(zlim) for zlim in args.zlim]
-    zlims = [(zlims[0], zlims[-1])]
+    if args.zbins:
+        zlims = list(zip(zlims[:-1], zlims[1:]))
+    else:
+        zlims = [(zlims[0], zlims[-1])]
+
+    # Catalog redshifts are cut to zlims before distances are computed: a single np.interp on a fixed table covering them,
+    # without TabulatedDESI's range checks (and picklable, for --nregions_parallel)
+    z_tab = np.linspace(0., max(zmax for zmin, zmax in zlims), 8192)
+    fast_distance = functools.partial(np.interp, xp=z_tab, fp=distance(z_tab))
 
+    # FFTW plans are measured once per process and grid shape; wisdom saved at the end lets the next runs skip measuring them
+    wisdom = load_wisdom(args.wisdom or None)
+
+    tasks = []
     for zmin, zmax in zlims:
         for region in regions:
-            logger.info('Running reconstruction in region {} in redshift range {} with f, bias = {}.'.format(region, (zmin, zmax), (f, bias)))
             catalog_kwargs = dict(tracer=args.tracer, region=region, ctype='clustering', nrandoms=args.nran, cat_dir=cat_dir, survey=args.survey)
             data_fn = catalog_fn(**catalog_kwargs, name='data')
             randoms_fn = catalog_fn(**catalog_kwargs, name='randoms')
-            data_rec_fn = catalog_fn(**catalog_kwargs, rec_type=args.algorithm+args.convention, name='data')
-            randoms_rec_fn = catalog_fn(**catalog_kwargs, rec_type=args.algorithm+args.convention, name='randoms')
-            run_reconstruction(Reconstruction, distance, data_fn, randoms_fn, data_rec_fn, randoms_rec_fn, f=f, bias=bias, boxsize=args.boxsize, nmesh=args.nmesh, cellsize=args.cellsize, smoothing_radius=args.smoothing_radius, nthreads=args.nthreads, convention=args.convention, dtype='f4', zlim=(zmin, zmax), weight_type=args.weight_type)
+            rec_type = args.algorithm + args.convention
+            if args.zbins: rec_type += '_z{}-{}'.format(zmin, zmax)
+            data_rec_fn = catalog_fn(**catalog_kwargs, rec_type=rec_type, name='data')
+            randoms_rec_fn = catalog_fn(**catalog_kwargs, rec_type=rec_type, name='randoms')
+            if not args.force and all(os.path.exists(fn) for fn in [data_rec_fn] + randoms_rec_fn):
+                logger.info('Skipping region {} in redshift range {}, as output catalogs already exist (use --force to overwrite).'.format(region, (zmin, zmax)))
+                continue
+            tasks.append(((data_fn, randoms_fn, data_rec_fn, randoms_rec_fn), dict(zlim=(zmin, zmax))))
+
+    # Each (region, redshift range) is independent; with several processes, the I/O of one overlaps with the FFTs of another
+    nthreads = max(args.nthreads // args.nregions_parallel, 1)
+    kwargs = dict(f=f, bias=bias, boxsize=args.boxsize, nmesh=args.nmesh, cellsize=args.cellsize, smoothing_radius=args.smoothing_radius, nthreads=nthreads, convention=args.convention, dtype='f4', stream_randoms=args.stream_randoms, weight_type=args.weight_type)
+    if args.nregions_parallel > 1:
+        # spawn rather than fork, not to copy the FFTW state of the parent process
+        with ProcessPoolExecutor(max_workers=args.nregions_parallel, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=(wisdom,)) as executor:
+            futures = [executor.submit(run_reconstruction_worker, Reconstruction, fast_distance, distance_to_redshift, *fns, **task_kwargs, **kwargs) for fns, task_kwargs in tasks]
+            wisdoms = [future.result() for future in futures]
+    else:
+        merge_wisdom(wisdom)
+        writes = []
+        for fns, task_kwargs in tasks:
+            # Outputs of one region are written while the next region is read and reconstructed
+            run_reconstruction(Reconstruction, fast_distance, distance_to_redshift, *fns, writes=writes, **task_kwargs, **kwargs)
+        wait_writes(writes)
+        wisdoms = []
+
+    if args.wisdom and tasks:
+        save_wisdom(args.wisdom, merge_wisdom(wisdom, *wisdoms))
@@ -6,7 +6,7 @@ import argparse
 import logging
 
 import numpy as np
-from astropy.table import Table, vstack
+import fitsio
 from matplotlib import pyplot as plt
 
 from pycorr import TwoPointCorrelationFunction, TwoPointEstimator, KMeansSubsampler, utils, setup_logging
@@ -16,6 +16,16 @@ from LSS.tabulated_cosmo import TabulatedDESI
 logger = logging.getLogger('xirunpc')
 
 
+def evaluate(expression, **arrays):
+    # Evaluate array expression in a single (multithreaded) pass, without temporaries, if numexpr is available; else with numpy.
+    # numexpr is imported here, not at module level, as it reads NUMEXPR_MAX_THREADS at import: scripts importing xirunpc (e.g. pkrun.py) can set it afterwards
+    try:
+        import numexpr
+    except ImportError:
+        return eval(expression, {}, arrays)
+    return numexpr.evaluate(expression, local_dict=arrays)
+
+
 def get_zlims(tracer, tracer2=None, option=None):
 
     if tracer2 is not None:
@@ -66,17 +76,12 @@ def get_regions(survey, rec=False):
 
 
 def select_region(ra, dec, region):
-    mask_ra = (ra > 100 - dec)
-    mask_ra &= (ra < 280 + dec)
+    # Single pass over ra, dec, without boolean temporaries if numexpr is available
     if region == 'DN':
-        mask = dec < 32.375
-        mask &= mask_ra
-    elif region == 'DS':
-        mask = dec > -25
-        mask &= ~mask_ra
-    else:
-        raise ValueError('Input region must be one of ["DN", "DS"].')
-    return mask
+        return evaluate('(ra > 100 - dec) & (ra < 280 + dec) & (dec < 32.375)', ra=ra, dec=dec)
+    if region == 'DS':
+        return evaluate('(dec > -25) & ~((ra > 100 - dec) & (ra < 280 + dec))', ra=ra, dec=dec)
+    raise ValueError('Input region must be one of ["DN", "DS"].')
 
 
 def catalog_dir(survey='main', verspec='guadalupe', version='test', base_dir='/global/cfs/cdirs/desi/survey/catalogs'):
@@ -95,13 +100,52 @@ def catalog_fn(tracer='ELG', region='', ctype='clustering', name='data', rec_typ
         tracer = 'LRG'
     if region: region = '_' + region
     if rec_type:
-        dat_or_ran = '{}.{}'.format(rec_type, dat_or_ran)
+        dat_or_ran = f'{rec_type}.{dat_or_ran}'
+    base = os.path.join(cat_dir, tracer + region)
     if name == 'data':
-        return os.path.join(cat_dir, '{}{}_{}.{}.fits'.format(tracer, region, ctype, dat_or_ran))
-    return [os.path.join(cat_dir, '{}{}_{:d}_{}.{}.fits'.format(tracer, region, iran, ctype, dat_or_ran)) for iran in range(nrandoms)]
+        return f'{base}_{ctype}.{dat_or_ran}.fits'
+    return [f'{base}_{iran:d}_{ctype}.{dat_or_ran}.fits' for iran in range(nrandoms)]
 
 
-def get_clustering_positions_weights(catalog, distance, zlim=(0., np.inf), weight_type='default', name='data', return_mask=False, option=None):
+def get_columns(ctype='clustering', name='data', weight_type='default', fibered=False, region=''):
+    # Columns to read from catalogs, given the weights and selection to apply
+    if ctype == 'full':
+        columns = ['RA', 'DEC']
+        if region and region not in ['DN', 'DS']: columns.append('PHOTSYS')
+        if fibered:
+            columns.append('LOCATION_ASSIGNED')
+            if 'bitwise' in weight_type: columns.append('BITWEIGHTS')
+        return columns
+    columns = ['RA', 'DEC', 'Z']
+    if 'zfail' in weight_type: columns.append('WEIGHT_ZFAIL')
+    if 'default' in weight_type and (name == 'randoms' or 'bitwise' not in weight_type): columns.append('WEIGHT')
+    if 'RF' in weight_type: columns += ['WEIGHT_RF', 'WEIGHT_COMP']
+    elif 'completeness_only' in weight_type: columns.append('WEIGHT_COMP')
+    if 'FKP' in weight_type: columns.append('WEIGHT_FKP')
+    if name == 'data' and 'bitwise' in weight_type: columns.append('BITWEIGHTS')
+    return columns
+
+
+def read_columns(fn, columns):
+    # Read catalog columns in one go, split into a dict of contiguous, native byte order arrays, which are faster to mask than record arrays
+    catalog = fitsio.read(fn, columns=columns, ext=1)
+    toret = {}
+    for column in columns:
+        array = catalog[column]
+        # Column-major bitwise weights, such that each integer (see get_bitweights) is contiguous
+        toret[column] = array.astype(array.dtype.newbyteorder('='), order='F' if array.ndim == 2 else 'C')
+    return toret
+
+
+def get_bitweights(catalog, mask):
+    # Bitwise weights as a list of contiguous arrays, one per integer, ready to be passed to the pair counter
+    bitweights = catalog['BITWEIGHTS']
+    if bitweights.ndim == 1: return [bitweights[mask]]
+    return [bitweights[:, i][mask] for i in range(bitweights.shape[1])]
+
+
+def get_clustering_positions_weights(catalog, distance, zlim=(0., np.inf), weight_type='default', name='data', return_mask=False, option=None, distances=None):
+    # distances: optionally, precomputed distances to all rows of catalog
 
     mask = (catalog['Z'] >= zlim[0]) & (catalog['Z'] < zlim[1])
     if option:
@@ -109,79 +153,126 @@ def get_clustering_positions_weights(catalog, distance, zlim=(0., np.inf), weigh
             zmask = ((catalog['Z'] >= 1.49) & (catalog['Z'] < 1.52))
             mask &= ~zmask
     logger.info('Using {:d} rows for {}.'.format(mask.sum(), name))
-    positions = [catalog['RA'][mask], catalog['DEC'][mask], distance(catalog['Z'][mask])]
-    weights = np.ones_like(positions[0])
+    # Distances in the same precision as RA, DEC
+    positions = [catalog['RA'][mask], catalog['DEC'][mask], np.asarray(distance(catalog['Z'][mask]) if distances is None else distances[mask], dtype=catalog['RA'].dtype.type)]
 
     if 'completeness_only' in weight_type and 'bitwise' in weight_type:
         raise ValueError('inconsistent choices were put into weight_type')
 
+    # Weight columns to be multiplied together
+    columns = []
     if name == 'data':
         if 'zfail' in weight_type:
-            weights *= catalog['WEIGHT_ZFAIL'][mask]
+            columns.append('WEIGHT_ZFAIL')
         if 'default' in weight_type and 'bitwise' not in weight_type:
-            weights *= catalog['WEIGHT'][mask]
+            columns.append('WEIGHT')
         if 'RF' in weight_type:
-            weights *= catalog['WEIGHT_RF'][mask]*catalog['WEIGHT_COMP'][mask]
-        if 'completeness_only' in weight_type:
-            weights = catalog['WEIGHT_COMP'][mask]
-        if 'FKP' in weight_type:
-            weights *= catalog['WEIGHT_FKP'][mask]
-        if 'bitwise' in weight_type:
-            if catalog['BITWEIGHTS'].ndim == 2: weights = list(catalog['BITWEIGHTS'][mask].T) + [weights]
-            else: weights = [catalog['BITWEIGHTS'][mask]] + [weights]
+            columns += ['WEIGHT_RF', 'WEIGHT_COMP']
 
     if name == 'randoms':
         if 'default' in weight_type:
-            weights *= catalog['WEIGHT'][mask]
+            columns.append('WEIGHT')
         if 'RF' in weight_type:
-            weights *= catalog['WEIGHT_RF'][mask]*catalog['WEIGHT_COMP'][mask]
+            columns += ['WEIGHT_RF', 'WEIGHT_COMP']
         if 'zfail' in weight_type:
-            weights *= catalog['WEIGHT_ZFAIL'][mask]
+            columns.append('WEIGHT_ZFAIL')
+
+    if name in ['data', 'randoms']:
         if 'completeness_only' in weight_type:
-            weights = catalog['WEIGHT_COMP'][mask]
+            columns = ['WEIGHT_COMP']
         if 'FKP' in weight_type:
-            weights *= catalog['WEIGHT_FKP'][mask]
+            columns.append('WEIGHT_FKP')
+
+    if len(columns) == 1:  # masking already returns a new array, no need for another one
+        weights = catalog[columns[0]][mask]
+    elif columns:
+        weights = evaluate(' * '.join(columns), **{column: catalog[column][mask] for column in columns})
+    else:
+        weights = np.ones_like(positions[0])
+
+    if name == 'data' and 'bitwise' in weight_type:
+        weights = get_bitweights(catalog, mask) + [weights]
 
     if return_mask:
         return positions, weights, mask
     return positions, weights
 
 
-def read_clustering_positions_weights(distance, zlim=(0., np.inf), weight_type='default', name='data', concatenate=False, option=None, **kwargs):
+def concatenate_arrays(arrays):
+    # Concatenate arrays, or lists of arrays (e.g. positions, list of bitwise weights) element-wise;
+    # in the latter case, output arrays are preallocated, as (contiguous) rows of a single buffer if they share the same dtype
+    if isinstance(arrays[0], (tuple, list)):
+        size = sum(len(arr[0]) for arr in arrays)
+        dtypes = [np.result_type(*[arr[iarr] for arr in arrays]) for iarr in range(len(arrays[0]))]
+        if len(set(dtypes)) == 1: toret = list(np.empty((len(dtypes), size), dtype=dtypes[0]))
+        else: toret = [np.empty(size, dtype=dtype) for dtype in dtypes]
+        for iarr, out in enumerate(toret):
+            np.concatenate([arr[iarr] for arr in arrays], axis=0, out=out)
+        return toret
+    return np.concatenate(arrays, axis=0)
+
+
+def read_clustering_positions_weights(distance, zlim=(0., np.inf), weight_type='default', name='data', concatenate=False, option=None, cache=None, dtype=None, **kwargs):
 
     cat_fns = catalog_fn(ctype='clustering', name=name, **kwargs)
-    logger.info('Loading {}.'.format(cat_fns))
     isscalar = not isinstance(cat_fns, (tuple, list))
     if isscalar:
         cat_fns = [cat_fns]
 
-    toret = [get_clustering_positions_weights(Table.read(cat_fn), distance, zlim=zlim, weight_type=weight_type, name=name, option=option) for cat_fn in cat_fns]
+    columns = get_columns(ctype='clustering', name=name, weight_type=weight_type)
+
+    def read(cat_fn):
+        # If a cache (dict) is provided, catalogs are read once and kept there, e.g. to cut them in several redshift ranges,
+        # together with distances, such that these are computed once as well
+        key = (cat_fn, tuple(columns))
+        if cache is None or key not in cache:
+            logger.info('Loading {}.'.format(cat_fn))
+            catalog = read_columns(cat_fn, columns)
+            if dtype is not None:
+                # Positions and weights are cast at read time; redshifts are kept as is for the redshift cuts
+                for column in columns:
+                    if column != 'Z' and catalog[column].dtype.kind == 'f': catalog[column] = catalog[column].astype(dtype, copy=False)
+            if cache is None:
+                return catalog, None
+            cache[key] = catalog, np.full_like(catalog['RA'], np.nan), np.zeros(len(catalog['Z']), dtype='?')
+        catalog, distances, done = cache[key]
+        # Distances are only computed for rows within zlim (and not done yet), as the distance table may not cover other redshifts
+        z = catalog['Z']
+        todo = (z >= zlim[0]) & (z < zlim[1]) & ~done
+        if todo.any():
+            distances[todo] = distance(z[todo])
+            done |= todo
+        return catalog, distances
+
+    toret = []
+    for cat_fn in cat_fns:
+        catalog, distances = read(cat_fn)
+        toret.append(get_clustering_positions_weights(catalog, distance, zlim=zlim, weight_type=weight_type, name=name, option=option, distances=distances))
     if isscalar:
         return toret[0]
     positions_weights = [[tmp[0] for tmp in toret], [tmp[1] for tmp in toret]]
     if concatenate:
-        for iarray, arrays in enumerate(positions_weights):
-            if isinstance(arrays[0], (tuple, list)):  # e.g., list of bitwise weights
-                array = [np.concatenate([arr[iarr] for arr in arrays], axis=0) for iarr in range(len(arrays[0]))]
-            else:
-                array = np.concatenate(arrays, axis=0)
-            positions_weights[iarray] = array
+        positions_weights = [concatenate_arrays(arrays) for arrays in positions_weights]
     return positions_weights
 
 
 def get_full_positions_weights(catalog, name='data', weight_type='default', fibered=False, region='', return_mask=False):
 
-    mask = np.ones(len(catalog), dtype='?')
+    # Region and fiber selections are combined in place into a single mask
+    mask = None
     if region in ['DS', 'DN']:
-        mask &= select_region(catalog['RA'], catalog['DEC'], region)
+        mask = select_region(catalog['RA'], catalog['DEC'], region)
     elif region:
-        mask &= catalog['PHOTSYS'] == region.strip('_')
-
-    if fibered: mask &= catalog['LOCATION_ASSIGNED']
+        photsys, region = catalog['PHOTSYS'], region.strip('_')
+        if photsys.dtype.kind == 'S': region = region.encode()  # fitsio returns bytes
+        mask = photsys == region
+    if fibered:
+        if mask is None: mask = np.array(catalog['LOCATION_ASSIGNED'], dtype='?')
+        else: mask &= catalog['LOCATION_ASSIGNED']
+    if mask is None: mask = np.ones(len(catalog['RA']), dtype='?')
     positions = [catalog['RA'][mask], catalog['DEC'][mask], catalog['DEC'][mask]]
     if fibered and 'bitwise' in weight_type:
-        if catalog['BITWEIGHTS'].ndim == 2: weights = list(catalog['BITWEIGHTS'][mask].T)
-        else: weights = [catalog['BITWEIGHTS'][mask]]
+        weights = get_bitweights(catalog, mask)
     else: weights = np.ones_like(positions[0])
     if return_mask:
         return positions, weights, mask
@@ -192,10 +283,13 @@ def read_full_positions_weights(name='data', weight_type='default', fibered=Fals
 
     cat_fn = catalog_fn(ctype='full', name=name, **kwargs)
     logger.info('Loading {}.'.format(cat_fn))
+    columns = get_columns(ctype='full', name=name, weight_type=weight_type, fibered=fibered, region=region)
     if isinstance(cat_fn, (tuple, list)):
-        catalog = vstack([Table.read(fn) for fn in cat_fn])
+        catalogs = [read_columns(fn, columns) for fn in cat_fn]
+        catalog = {column: np.concatenate([catalog[column] for catalog in catalogs]) for column in columns}
+        del catalogs
     else:
-        catalog = Table.read(cat_fn)
+        catalog = read_columns(cat_fn, columns)
     return get_full_positions_weights(catalog, name=name, weight_type=weight_type, fibered=fibered, region=region)
 
 
@@ -254,17 +348,24 @@ def compute_angular_weights(nthreads=8, dtype='f8', tracer='ELG', tracer2=None,
     return wang
 
 
-def compute_correlation_function(corr_type, edges, distance, nthreads=8, dtype='f8', wang=None, split_randoms_above=30., weight_type='default', tracer='ELG', tracer2=None, rec_type=None, njack=120,option=None, mpicomm=None, mpiroot=None, **kwargs):
+def label_positions(subsampler, *catalogs):
+    # Label all catalogs (each a list of positions, or None) with a single subsampler.label call, and split labels back
+    positions = [pos for catalog in catalogs if catalog is not None for pos in catalog]
+    labels = subsampler.label([np.concatenate([pos[i] for pos in positions]) for i in range(len(positions[0]))])
+    labels = iter(np.split(labels, np.cumsum([len(pos[0]) for pos in positions])[:-1]))
+    return [None if catalog is None else [next(labels) for pos in catalog] for catalog in catalogs]
+
+
+def read_correlation_catalogs(distance, dtype='f4', weight_type='default', tracer='ELG', tracer2=None, rec_type=None, njack=120, option=None, mpicomm=None, mpiroot=None, **kwargs):
+    # Positions, weights and jack-knife labels of data, randoms and shifted randoms, to be passed to TwoPointCorrelationFunction;
+    # these do not depend on corr_type, so can be read once for all correlation functions
 
     autocorr = tracer2 is None
     catalog_kwargs = kwargs.copy()
     catalog_kwargs['weight_type'] = weight_type
+    catalog_kwargs['dtype'] = dtype
     with_shifted = rec_type is not None
 
-    if 'angular' in weight_type and wang is None:
-
-        wang = compute_angular_weights(nthreads=nthreads, dtype=dtype, weight_type=weight_type, tracer=tracer, tracer2=tracer2, mpicomm=mpicomm, mpiroot=mpiroot, **kwargs)
-
     data_positions1, data_weights1, data_samples1, data_positions2, data_weights2, data_samples2 = None, None, None, None, None, None
     randoms_positions1, randoms_weights1, randoms_samples1, randoms_positions2, randoms_weights2, randoms_samples2 = None, None, None, None, None, None
     shifted_positions1, shifted_weights1, shifted_samples1, shifted_positions2, shifted_weights2, shifted_samples2 = None, None, None, None, None, None
@@ -294,22 +395,35 @@ def compute_correlation_function(corr_type, edges, distance, nthreads=8, dtype='
                                       dtype=dtype, mpicomm=mpicomm, mpiroot=mpiroot)
 
         if mpicomm is None or mpicomm.rank == mpiroot:
-            data_samples1 = subsampler.label(data_positions1)
-            randoms_samples1 = [subsampler.label(p) for p in randoms_positions1]
-            if with_shifted:
-                shifted_samples1 = [subsampler.label(p) for p in shifted_positions1]
-            if not autocorr:
-                data_samples2 = subsampler.label(data_positions2)
-                randoms_samples2 = [subsampler.label(p) for p in randoms_positions2]
-                if with_shifted:
-                    shifted_samples2 = [subsampler.label(p) for p in shifted_positions2]
+            samples = label_positions(subsampler, [data_positions1], randoms_positions1, shifted_positions1,
+                                      None if autocorr else [data_positions2], randoms_positions2, shifted_positions2)
+            data_samples1, randoms_samples1, shifted_samples1, data_samples2, randoms_samples2, shifted_samples2 = samples
+            data_samples1 = data_samples1[0]
+            if not autocorr: data_samples2 = data_samples2[0]
+
+    return dict(data_positions1=data_positions1, data_weights1=data_weights1, data_samples1=data_samples1,
+                data_positions2=data_positions2, data_weights2=data_weights2, data_samples2=data_samples2,
+                randoms_positions1=randoms_positions1, randoms_weights1=randoms_weights1, randoms_samples1=randoms_samples1,
+                randoms_positions2=randoms_positions2, randoms_weights2=randoms_weights2, randoms_samples2=randoms_samples2,
+                shifted_positions1=shifted_positions1, shifted_weights1=shifted_weights1, shifted_samples1=shifted_samples1,
+                shifted_positions2=shifted_positions2, shifted_weights2=shifted_weights2, shifted_samples2=shifted_samples2)
+
+
+def compute_correlation_function(corr_type, edges, distance, nthreads=8, dtype='f4', wang=None, split_randoms_above=30., weight_type='default', tracer='ELG', tracer2=None, rec_type=None, njack=120,option=None, catalogs=None, cache=None, mpicomm=None, mpiroot=None, **kwargs):
+
+    if 'angular' in weight_type and wang is None:
+
+        # Angular weights are computed down to 1e-4 deg, kept in double precision
+        wang = compute_angular_weights(nthreads=nthreads, dtype='f8', weight_type=weight_type, tracer=tracer, tracer2=tracer2, mpicomm=mpicomm, mpiroot=mpiroot, **kwargs)
+
+    if catalogs is None:
+        catalogs = read_correlation_catalogs(distance, dtype=dtype, weight_type=weight_type, tracer=tracer, tracer2=tracer2, rec_type=rec_type, njack=njack, option=option, cache=cache, mpicomm=mpicomm, mpiroot=mpiroot, **kwargs)
 
     kwargs = {}
     kwargs.update(wang or {})
-    randoms_kwargs = dict(randoms_positions1=randoms_positions1, randoms_weights1=randoms_weights1, randoms_samples1=randoms_samples1,
-                          randoms_positions2=randoms_positions2, randoms_weights2=randoms_weights2, randoms_samples2=randoms_samples2,
-                          shifted_positions1=shifted_positions1, shifted_weights1=shifted_weights1, shifted_samples1=shifted_samples1,
-                          shifted_positions2=shifted_positions2, shifted_weights2=shifted_weights2, shifted_samples2=shifted_samples2)
+    data_kwargs = {name: array for name, array in catalogs.items() if name.startswith('data_')}
+    randoms_kwargs = {name: array for name, array in catalogs.items() if name.startswith(('randoms_', 'shifted_'))}
+    randoms_positions1 = randoms_kwargs['randoms_positions1']
 
     zedges = np.array(list(zip(edges[0][:-1], edges[0][1:])))
     mask = zedges[:,0] >= split_randoms_above
@@ -320,13 +434,19 @@ def compute_correlation_function(corr_type, edges, distance, nthreads=8, dtype='
             split_edges.append([np.append(zedge[:,0], zedge[-1,-1])] + list(edges[1:]))
             split_randoms.append(ii > 0)
 
+    if not all(split_randoms):
+        # On scales below split_randoms_above, randoms are concatenated; this is done once, and kept in catalogs for other corr_type
+        if 'concatenated_randoms' not in catalogs:
+            catalogs['concatenated_randoms'] = {name: concatenate_arrays(arrays) for name, arrays in randoms_kwargs.items() if arrays is not None}
+        concatenated_randoms_kwargs = catalogs['concatenated_randoms']
+
     results = []
     if mpicomm is None:
         nran = len(randoms_positions1)
     else:
         nran = mpicomm.bcast(len(randoms_positions1) if mpicomm.rank == mpiroot else None, root=mpiroot)
     for i_split_randoms, edges in zip(split_randoms, split_edges):
-        result = 0
+        tmps = []
         D1D2 = None
         for iran in range(nran if i_split_randoms else 1):
             tmp_randoms_kwargs = {}
@@ -338,42 +458,39 @@ def compute_correlation_function(corr_type, edges, distance, nthreads=8, dtype='
                     else:
                         tmp_randoms_kwargs[name] = arrays[iran]
             else:
-                # On scales below split_randoms_above, concatenate randoms
-                for name, arrays in randoms_kwargs.items():
-                    if arrays is None:
-                        continue
-                    elif isinstance(arrays[0], (tuple, list)):  # e.g., list of bitwise weights
-                        array = [np.concatenate([arr[iarr] for arr in arrays], axis=0) for iarr in range(len(arrays[0]))]
-                    else:
-                        array = np.concatenate(arrays, axis=0)
-                    tmp_randoms_kwargs[name] = array
-            tmp = TwoPointCorrelationFunction(corr_type, edges, data_positions1=data_positions1, data_weights1=data_weights1, data_samples1=data_samples1,
-                                              data_positions2=data_positions2, data_weights2=data_weights2, data_samples2=data_samples2,
+                # On scales below split_randoms_above, use concatenated randoms
+                tmp_randoms_kwargs = concatenated_randoms_kwargs
+            tmp = TwoPointCorrelationFunction(corr_type, edges, **data_kwargs,
                                               engine='corrfunc', position_type='rdd', nthreads=nthreads, dtype=dtype, **tmp_randoms_kwargs, **kwargs,
                                               D1D2=D1D2, mpicomm=mpicomm, mpiroot=mpiroot)
             D1D2 = tmp.D1D2
-            result += tmp
-        results.append(result)
+            tmps.append(tmp)
+        # Sum correlation functions over randoms in one go
+        results.append(tmps[0].sum(*tmps) if len(tmps) > 1 else tmps[0])
     return results[0].concatenate_x(*results), wang
 
 
+# Edges are built once, and shared by all get_edges calls: not to be modified in place
+SEDGES = {'log': np.geomspace(0.01, 100., 49), 'lin': np.linspace(0., 200, 201)}
+MUEDGES = np.linspace(-1., 1., 201)
+PIEDGES = np.linspace(0., 40., 41)
+THETAEDGES = np.linspace(0., 4., 101)
+
+
 def get_edges(corr_type='smu', bin_type='lin'):
 
-    if bin_type == 'log':
-        sedges = np.geomspace(0.01, 100., 49)
-    elif bin_type == 'lin':
-        sedges = np.linspace(0., 200, 201)
-    else:
+    if bin_type not in SEDGES:
         raise ValueError('bin_type must be one of ["log", "lin"]')
+    sedges = SEDGES[bin_type]
     if corr_type == 'smu':
-        edges = (sedges, np.linspace(-1., 1., 201)) #s is input edges and mu evenly spaced between -1 and 1
+        edges = (sedges, MUEDGES) #s is input edges and mu evenly spaced between -1 and 1
     elif corr_type == 'rppi':
         if bin_type == 'lin':
             edges = (sedges, sedges) #transverse and radial separations are coded to be the same here
         else:
-            edges = (sedges, np.linspace(0., 40., 41))
+            edges = (sedges, PIEDGES)
     elif corr_type == 'theta':
-        edges = np.linspace(0., 4., 101)
+        edges = THETAEDGES
     else:
         raise ValueError('corr_type must be one of ["smu", "rppi", "theta"]')
     return edges
@@ -411,12 +528,15 @@ if __name__ == '__main__':
                         type=float, default=np.inf)
     parser.add_argument('--njack', help='number of jack-knife subsamples; 0 for no jack-knife error estimates', type=int, default=60)
     parser.add_argument('--nthreads', help='number of threads', type=int, default=64)
+    parser.add_argument('--dtype', help='precision of positions and weights for pair counting', type=str, choices=['f4', 'f8'], default='f4')
+    parser.add_argument('--ngroups', help='number of groups of MPI ranks, each group computing correlation functions for its own (region, redshift range) pairs', type=int, default=1)
     parser.add_argument('--outdir', help='base directory for output', type=str, default=None)
     #parser.add_argument('--mpi', help='whether to use MPI', action='store_true', default=False)
     parser.add_argument('--vis', help='show plot of each xi?', action='store_true', default=False)
 
     #only relevant for reconstruction
     parser.add_argument('--rec_type', help='reconstruction algorithm + reconstruction convention', choices=['IFTrecsym', 'IFTreciso', 'MGrecsym', 'MGreciso'], type=str, default=None)
+    parser.add_argument('--rec_zbins', help='reconstructed catalogs were produced separately in each redshift bin of --zlim (recon.py --zbins), hence are suffixed by the redshift range; the full redshift range is then skipped', action='store_true', default=False)
 
     setup_logging()
     args = parser.parse_args()
@@ -456,37 +576,83 @@ if __name__ == '__main__':
         zlims = get_zlims(tracer, tracer2=tracer2,option=option )
     else:
         zlims = [float(zlim) for zlim in args.zlim]
-    zlims = list(zip(zlims[:-1], zlims[1:])) + ([(zlims[0], zlims[-1])] if len(zlims) > 2 else []) # len(zlims) == 2 == single redshift range
+    zlims = list(zip(zlims[:-1], zlims[1:])) + ([(zlims[0], zlims[-1])] if len(zlims) > 2 and not args.rec_zbins else []) # len(zlims) == 2 == single redshift range
 
     rebinning_factors = [1, 4, 5, 10] if 'lin' in args.bin_type else [1,2,4]
     pi_rebinning_factors = [1, 4, 5, 10] if 'log' in args.bin_type else [1]
     if mpicomm is None or mpicomm.rank == mpiroot:
         logger.info('Computing correlation functions {} in regions {} in redshift ranges {}.'.format(args.corr_type, regions, zlims))
 
-    for zmin, zmax in zlims:
-        base_file_kwargs = dict(tracer=tracer, tracer2=tracer2, zmin=zmin, zmax=zmax, rec_type=args.rec_type, weight_type=args.weight_type, bin_type=args.bin_type, njack=args.njack, option=option)
-        for region in regions:
+    def get_rec_type(zmin, zmax):
+        # Same suffix as recon.py --zbins, e.g. MGreciso_z0.8-1.1
+        if args.rec_type and args.rec_zbins: return '{}_z{}-{}'.format(args.rec_type, zmin, zmax)
+        return args.rec_type
+
+    def get_base_file_kwargs(zmin, zmax):
+        return dict(tracer=tracer, tracer2=tracer2, zmin=zmin, zmax=zmax, rec_type=get_rec_type(zmin, zmax), weight_type=args.weight_type, bin_type=args.bin_type, njack=args.njack, option=option)
+
+    # (region, redshift range) pairs are split between groups of ranks, each with its own communicator;
+    # pairs are given in contiguous chunks, such that catalogs read in a region are reused for the next redshift ranges
+    tasks = [(region, zlim) for region in regions for zlim in zlims]
+    task_mpicomm = mpicomm
+    if mpicomm is not None and args.ngroups > 1:
+        ngroups = min(args.ngroups, len(tasks), mpicomm.size)
+        igroup = mpicomm.rank * ngroups // mpicomm.size
+        task_mpicomm = mpicomm.Split(igroup, mpicomm.rank)
+        tasks = tasks[igroup * len(tasks) // ngroups:(igroup + 1) * len(tasks) // ngroups]
+
+    # Results are kept in memory for the combination and .txt files below, instead of being reloaded
+    results = {}
+    last_region = None
+    for region, (zmin, zmax) in tasks:
+        if region != last_region:
+            # Catalogs are read once per region, then cut in each redshift range
+            cache = {}
+            # Angular weights are computed from full catalogs, without redshift cuts, hence are the same for all redshift ranges
             wang = None
-            for corr_type in args.corr_type:
-                if mpicomm is None or mpicomm.rank == mpiroot:
-                    logger.info('Computing correlation function {} in region {} in redshift range {}.'.format(corr_type, region, (zmin, zmax)))
-                edges = get_edges(corr_type=corr_type, bin_type=args.bin_type)
-                result, wang = compute_correlation_function(corr_type, edges=edges, distance=distance, nrandoms=args.nran, split_randoms_above=args.split_ran_above, nthreads=args.nthreads, region=region, zlim=(zmin, zmax), weight_type=args.weight_type, njack=args.njack, wang=wang, mpicomm=mpicomm, mpiroot=mpiroot,option=option, **catalog_kwargs)
-                #save pair counts
-                result.save(corr_fn(file_type='npy', region=region, out_dir=os.path.join(out_dir, corr_type), **base_file_kwargs))
+            last_region = region
+        base_file_kwargs = get_base_file_kwargs(zmin, zmax)
+        task_catalog_kwargs = dict(catalog_kwargs, rec_type=get_rec_type(zmin, zmax))
+        # Positions, weights and jack-knife labels are shared by all correlation function types
+        catalogs = read_correlation_catalogs(distance, dtype=args.dtype, nrandoms=args.nran, region=region, zlim=(zmin, zmax), weight_type=args.weight_type, njack=args.njack, cache=cache, mpicomm=task_mpicomm, mpiroot=mpiroot, option=option, **task_catalog_kwargs)
+        for corr_type in args.corr_type:
+            if task_mpicomm is None or task_mpicomm.rank == mpiroot:
+                logger.info('Computing correlation function {} in region {} in redshift range {}.'.format(corr_type, region, (zmin, zmax)))
+            edges = get_edges(corr_type=corr_type, bin_type=args.bin_type)
+            result, wang = compute_correlation_function(corr_type, edges=edges, distance=distance, dtype=args.dtype, nrandoms=args.nran, split_randoms_above=args.split_ran_above, nthreads=args.nthreads, region=region, zlim=(zmin, zmax), weight_type=args.weight_type, njack=args.njack, wang=wang, catalogs=catalogs, mpicomm=task_mpicomm, mpiroot=mpiroot,option=option, **task_catalog_kwargs)
+            #save pair counts
+            result.save(corr_fn(file_type='npy', region=region, out_dir=os.path.join(out_dir, corr_type), **base_file_kwargs))
+            results[zmin, zmax, corr_type, region] = result
+        del catalogs
+        if args.rec_type and args.rec_zbins:
+            # Catalogs reconstructed in this redshift bin are not used by any other one: release them
+            suffix = '.{}.'.format(task_catalog_kwargs['rec_type'])
+            for key in [key for key in cache if suffix in os.path.basename(key[0])]: del cache[key]
+    cache = None
+
+    def get_result(zmin, zmax, corr_type, region):
+        # Results computed by other groups of ranks are read from disk
+        if (zmin, zmax, corr_type, region) not in results:
+            results[zmin, zmax, corr_type, region] = TwoPointCorrelationFunction.load(corr_fn(file_type='npy', region=region, out_dir=os.path.join(out_dir, corr_type), **get_base_file_kwargs(zmin, zmax)))
+        return results[zmin, zmax, corr_type, region]
+
+    if task_mpicomm is not mpicomm:
+        mpicomm.Barrier()
 
+    for zmin, zmax in zlims:
+        base_file_kwargs = get_base_file_kwargs(zmin, zmax)
         # Save combination and .txt files
         for corr_type in args.corr_type:
             all_regions = regions.copy()
             if 'N' in regions and 'S' in regions:  # let's combine
-                corr = sum([TwoPointCorrelationFunction.load(
-                            corr_fn(file_type='npy', region=region, out_dir=os.path.join(out_dir, corr_type), **base_file_kwargs)).normalize() for region in 'NS'])
+                corr = sum([get_result(zmin, zmax, corr_type, region).normalize() for region in 'NS'])
                 corr.save(corr_fn(file_type='npy', region='NScomb', out_dir=os.path.join(out_dir, corr_type), **base_file_kwargs))
+                results[zmin, zmax, corr_type, 'NScomb'] = corr
                 all_regions.append('NScomb')
             for region in all_regions:
                 txt_kwargs = base_file_kwargs.copy()
                 txt_kwargs.update(region=region, out_dir=os.path.join(out_dir, corr_type))
-                result = TwoPointCorrelationFunction.load(corr_fn(file_type='npy', **txt_kwargs))
+                result = get_result(zmin, zmax, corr_type, region)
                 for factor in rebinning_factors:
                     #result = TwoPointEstimator.load(fn)
                     rebinned = result[:(result.shape[0]//factor)*factor:factor]
@@ -502,10 +668,11 @@ if __name__ == '__main__':
                         fn_txt = corr_fn(file_type='wp', **txt_kwargs)
                         rebinned.save_txt(fn_txt, pimax=40.)
                         for pifac in pi_rebinning_factors:
-                            rebinned = result[:(result.shape[0]//factor)*factor:factor,:(result.shape[1]//pifac)*pifac:pifac]
+                            # rebinned is already rebinned along rp; only rebin along pi
+                            pi_rebinned = rebinned[:,:(rebinned.shape[1]//pifac)*pifac:pifac]
                             txt_kwargs.update(bin_type=args.bin_type+str(factor)+'_'+str(pifac))
                             fn_txt = corr_fn(file_type='xirppi', **txt_kwargs)
-                            rebinned.save_txt(fn_txt)
+                            pi_rebinned.save_txt(fn_txt)
                     elif corr_type == 'theta':
                         fn_txt = corr_fn(file_type='theta', **txt_kwargs)
                         rebinned.save_txt(fn_txt)